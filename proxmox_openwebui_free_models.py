@@ -16,104 +16,214 @@ Options:
   --db PATH              Path to webui.db (required)
   --config-index INDEX   openai.api_configs index to write (default: 0)
   --apply                Write changes (otherwise dry-run)
+  --no-cache             Always download the full model list (skip ETag revalidation)
   --verbose              Verbose output
 """
 
 import os
+import re
 import sys
 import json
 import sqlite3
 import argparse
+import tempfile
 import urllib.request
 from urllib.error import URLError, HTTPError
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 OPENROUTER_MODELS_URL = "https://openrouter.ai/api/v1/models"
+FREE_ID_SUFFIXES = ("/free", "-free", " (free)")
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "proxmox_openwebui"
+)
+MODELS_CACHE_PATH = os.path.join(CACHE_DIR, "models.json")
+
+# Constant statement texts. The JSON path is passed as a bound parameter; the
+# config index is spliced into that path, so it is validated first.
+SELECT_ALLOWLIST_SQL = """
+    SELECT
+        json_valid(data),
+        CASE WHEN json_valid(data) THEN json_type(data) END,
+        CASE WHEN json_valid(data) THEN json_type(data, '$.openai') END,
+        CASE WHEN json_valid(data) THEN json_type(data, '$.openai.api_configs') END,
+        CASE WHEN json_valid(data) THEN json_type(data, :target) END,
+        CASE WHEN json_valid(data) THEN json_array_length(data, :target || '.model_ids') END
+    FROM config WHERE id=1
+"""
+UPDATE_ALLOWLIST_SQL = """
+    UPDATE config SET data = json_insert(
+        json_patch(data, :patch),
+        :target || '.enable', json('true'),
+        :target || '.connection_type', 'external',
+        :target || '.tags', json('[]'),
+        :target || '.prefix_id', ''
+    ), updated_at=CURRENT_TIMESTAMP
+    WHERE id=1
+"""
+CONFIG_INDEX_RE = re.compile(r"[A-Za-z0-9_-]+")
+
+
+def load_json(raw):
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
 
+def write_atomic(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def http_json(url, headers, cache_path=None, revalidate=True):
+    etag_path = cache_path + ".etag" if cache_path else None
+    headers = dict(headers)
+    if revalidate and cache_path and os.path.exists(cache_path) and os.path.exists(etag_path):
+        with open(etag_path, "r", encoding="utf-8") as f:
+            headers["If-None-Match"] = f.read().strip()
 
-def http_json(url, headers):
     req = urllib.request.Request(url, headers=headers)
-    with urllib.request.urlopen(req, timeout=30) as r:
-        return json.loads(r.read().decode("utf-8"))
+    try:
+        with urllib.request.urlopen(req, timeout=30) as r:
+            body = r.read()
+            etag = r.headers.get("ETag")
+    except HTTPError as e:
+        if e.code != 304 or "If-None-Match" not in headers:
+            raise
+        try:
+            with open(cache_path, "rb") as f:
+                return load_json(f.read())
+        except (OSError, ValueError):
+            # Damaged cache: refetch in full, which also rewrites it.
+            del headers["If-None-Match"]
+            return http_json(url, headers, cache_path, revalidate=False)
+
+    if cache_path and etag:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            # Body first: an ETag on disk never outlives the body it names.
+            write_atomic(cache_path, body)
+            write_atomic(etag_path, etag.encode("utf-8"))
+        except OSError:
+            pass  # cache is best-effort
+    return load_json(body)
+
+
+def dump_json(obj):
+    if orjson:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
 
 
 def is_free_model(model_obj):
     mid = model_obj.get("id", "") or ""
-    if (":free" in mid) or mid.endswith("/free") or mid.endswith("-free") or mid.endswith(" (free)"):
+    if ":free" in mid or mid.endswith(FREE_ID_SUFFIXES):
         return True
     pricing = model_obj.get("pricing") or {}
-    values = []
     for v in pricing.values():
-        if isinstance(v, dict):
-            values.extend(v.values())
-        else:
-            values.append(v)
-    for v in values:
-        if v is None:
-            continue
-        try:
-            if float(v) > 0.0:
-                return False
-        except Exception:
-            pass
+        for sub in (v.values() if isinstance(v, dict) else (v,)):
+            if sub is None:
+                continue
+            try:
+                if float(sub) > 0.0:
+                    return False
+            except Exception:
+                pass
     return True
 
 
-def fetch_free_ids(api_key):
+def fetch_free_ids(api_key, use_cache=True):
     headers = {"Authorization": f"Bearer {api_key}", "Accept": "application/json"}
-    data = http_json(OPENROUTER_MODELS_URL, headers)
+    data = http_json(OPENROUTER_MODELS_URL, headers, MODELS_CACHE_PATH, revalidate=use_cache)
     models = data.get("data") or data.get("models") or []
-    free_ids = sorted({m.get("id") for m in models if m.get("id") and is_free_model(m)})
-    paid_count = len([1 for m in models if m.get("id") and not is_free_model(m)])
-    return free_ids, len(models), paid_count
+    free = {}  # insertion-ordered dedupe, keeps OpenRouter's catalog order
+    paid_count = 0
+    for m in models:
+        mid = m.get("id")
+        if not mid:
+            continue
+        if is_free_model(m):
+            free[mid] = None
+        else:
+            paid_count += 1
+    return list(free), len(models), paid_count
 
 
 def update_allowlist(db_path, free_ids, index="0", apply=False, verbose=False):
+    # The index is spliced into a JSON path, so only allow plain keys.
+    if not CONFIG_INDEX_RE.fullmatch(index):
+        raise ValueError(f"invalid config index: {index!r}")
+
     conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
     cur = conn.cursor()
 
-    row = cur.execute("SELECT id, data FROM config WHERE id=1").fetchone()
-    if not row:
-        raise RuntimeError("config row not found (id=1)")
+    target = f'$.openai.api_configs."{index}"'
+    new_list = list(free_ids)
 
-    cfg = json.loads(row["data"])
-    cfg.setdefault("openai", {})
-    cfg["openai"].setdefault("api_configs", {})
-    cfg["openai"]["api_configs"].setdefault(index, {})
+    try:
+        row = cur.execute(SELECT_ALLOWLIST_SQL, {"target": target}).fetchone()
+        if not row:
+            raise RuntimeError("config row not found (id=1)")
+        valid, root_type, openai_type, configs_type, target_type, old_count = row
+        if not valid:
+            raise RuntimeError("config row has no valid JSON data (id=1)")
+        # json_patch would silently replace these with objects; refuse instead.
+        for path, json_type in (
+            ("$", root_type),
+            ("openai", openai_type),
+            ("openai.api_configs", configs_type),
+            (f"openai.api_configs.{index}", target_type),
+        ):
+            if json_type is not None and json_type != "object":
+                raise RuntimeError(f"config data: {path} is a JSON {json_type}, expected an object")
+        old_count = old_count or 0
 
-    target = cfg["openai"]["api_configs"][index]
-    target.setdefault("enable", True)
-    target.setdefault("connection_type", "external")
-    target.setdefault("tags", [])
-    target.setdefault("prefix_id", "")
+        if verbose:
+            print(f"[i] existing allowlist: {old_count}")
+            print(f"[i] new allowlist     : {len(new_list)}")
+            if new_list:
+                print(f"[i] first 10 IDs     : {new_list[:10]}")
 
-    old_list = target.get("model_ids", [])
-    new_list = list(free_ids)
+        if not apply:
+            return False
 
-    if verbose:
-        print(f"[i] existing allowlist: {len(old_list)}")
-        print(f"[i] new allowlist     : {len(new_list)}")
-        if new_list:
-            print(f"[i] first 10 IDs     : {new_list[:10]}")
+        # json_patch creates missing parents and replaces model_ids;
+        # json_insert only fills connection defaults that are absent.
+        patch = {"openai": {"api_configs": {index: {"model_ids": new_list}}}}
+        with conn:
+            cur.execute(
+                UPDATE_ALLOWLIST_SQL,
+                {"patch": dump_json(patch), "target": target},
+            )
+        return True
+    finally:
+        conn.close()
 
-    if not apply:
-        return False
 
-    target["model_ids"] = new_list
-    cur.execute(
-        "UPDATE config SET data=?, updated_at=CURRENT_TIMESTAMP WHERE id=1",
-        (json.dumps(cfg, ensure_ascii=False),),
-    )
-    conn.commit()
-    conn.close()
-    return True
+def config_index(value):
+    # Same check as update_allowlist, but as a usage error before any download.
+    if not CONFIG_INDEX_RE.fullmatch(value):
+        raise argparse.ArgumentTypeError(f"invalid config index: {value!r} (use letters, digits, '_' or '-')")
+    return value
 
 
 def main():
     ap = argparse.ArgumentParser(description="Write only-free OpenRouter IDs into OpenWebUI allowlist.")
     ap.add_argument("--db", required=True, help="Path to webui.db (e.g. /opt/open-webui/backend/data/webui.db)")
-    ap.add_argument("--config-index", default="0", help="Which openai.api_configs index to write (default: 0)")
+    ap.add_argument(
+        "--config-index", type=config_index, default="0", help="Which openai.api_configs index to write (default: 0)"
+    )
     ap.add_argument("--apply", action="store_true", help="Write changes (otherwise dry-run)")
+    ap.add_argument(
+        "--no-cache", action="store_true", help="Always download the full model list (skip ETag revalidation)"
+    )
     ap.add_argument("--verbose", action="store_true")
     args = ap.parse_args()
 
@@ -122,7 +232,7 @@ def main():
         print("ERROR: Set OPENROUTER_API_KEY environment variable.", file=sys.stderr)
         sys.exit(1)
 
-    free_ids, total, paid = fetch_free_ids(api_key)
+    free_ids, total, paid = fetch_free_ids(api_key, use_cache=not args.no_cache)
     free = len(free_ids)
 
     print(f"OpenRouter models: {total}  |  FREE: {free}  |  PAID: {paid}")